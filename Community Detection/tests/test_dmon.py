@@ -0,0 +1,199 @@
+"""Tests for the DMoN layers in tools/dmon.py."""
+import importlib.util
+import os
+import sys
+import unittest
+from unittest import mock
+
+import numpy as np
+import tensorflow.compat.v2 as tf
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from tools import dmon  # pylint: disable=g-import-not-at-top
+
+_HAS_NUMBA = importlib.util.find_spec('numba') is not None
+
+
+def _random_graph(n_nodes, n_edges, seed=0):
+  """Returns a random symmetric sparse adjacency matrix."""
+  rng = np.random.default_rng(seed)
+  edges = rng.integers(0, n_nodes, size=(n_edges, 2))
+  edges = np.unique(np.concatenate([edges, edges[:, ::-1]]), axis=0)
+  return tf.sparse.reorder(tf.SparseTensor(
+      edges.astype(np.int64), np.ones(len(edges), np.float32),
+      (n_nodes, n_nodes)))
+
+
+def _functional_dmon(n_nodes, n_features, layer):
+  """Wraps `layer` in a functional model over (features, adjacency) inputs."""
+  features = tf.keras.layers.Input(shape=(n_features,))
+  adjacency = tf.keras.layers.Input((n_nodes,), sparse=True)
+  pool, pool_assignment = layer([features, adjacency])
+  return tf.keras.Model(inputs=[features, adjacency],
+                        outputs=[pool, pool_assignment])
+
+
+class DMoNTest(tf.test.TestCase):
+
+  def test_csr_conversion_is_cached_across_functional_calls(self):
+    n_nodes, n_features, n_clusters = 64, 8, 16
+    adjacency = _random_graph(n_nodes, 256)
+    features = tf.random.normal((n_nodes, n_features))
+    model = _functional_dmon(n_nodes, n_features,
+                             dmon.DMoN(n_clusters, use_csr=True))
+    with mock.patch.object(dmon, '_sparse_tensor_to_csr',
+                           wraps=dmon._sparse_tensor_to_csr) as to_csr:
+      model([features, adjacency], training=True)
+      model([features, adjacency], training=True)
+    self.assertEqual(to_csr.call_count, 1)
+
+  def test_default_product_does_not_convert_to_csr(self):
+    n_nodes, n_features, n_clusters = 64, 8, 16
+    adjacency = _random_graph(n_nodes, 256)
+    features = tf.random.normal((n_nodes, n_features))
+    model = _functional_dmon(n_nodes, n_features, dmon.DMoN(n_clusters))
+    with mock.patch.object(dmon, '_sparse_tensor_to_csr',
+                           wraps=dmon._sparse_tensor_to_csr) as to_csr:
+      model([features, adjacency], training=True)
+    to_csr.assert_not_called()
+
+  def test_csr_conversion_is_cached_across_rebuilt_sparse_tensors(self):
+    # Functional models may pass the adjacency through a same-dtype tf.cast,
+    # which returns a new SparseTensor around the same indices and values.
+    adjacency = _random_graph(64, 256)
+    with mock.patch.object(dmon, '_sparse_tensor_to_csr',
+                           wraps=dmon._sparse_tensor_to_csr) as to_csr:
+      dmon._to_csr(adjacency)
+      dmon._to_csr(tf.cast(adjacency, tf.float32))
+    self.assertEqual(to_csr.call_count, 1)
+
+  def test_precomputed_degrees_match_cached_degrees(self):
+    n_nodes, n_features = 32, 4
+    adjacency = _random_graph(n_nodes, 64, seed=1)
+    diverse_adjacency = _random_graph(n_nodes, 64, seed=2)
+    features = tf.random.normal((n_nodes, n_features))
+    inputs = [features, adjacency, diverse_adjacency]
+    degrees = tuple(tf.sparse.reduce_sum(graph, axis=0)
+                    for graph in (adjacency, diverse_adjacency))
+    layer = dmon.diverseDMoN(4)
+    layer(inputs, 0.5)
+    cached_losses = list(layer.losses)
+    layer(inputs, 0.5, degrees=degrees)
+    self.assertAllClose(cached_losses, layer.losses)
+
+  def _assert_bsr_matmul_matches(self, adjacency, block_size):
+    dense = tf.random.normal((adjacency.dense_shape[0], 5))
+    bsr_adjacency = dmon.bsr_from_coo(
+        adjacency.indices.numpy(), adjacency.values.numpy(),
+        adjacency.dense_shape.numpy(), block_size)
+    self.assertAllClose(dmon.bsr_matmul(*bsr_adjacency, dense),
+                        tf.sparse.sparse_dense_matmul(adjacency, dense))
+
+  def test_bsr_matmul_matches_sparse_dense_matmul(self):
+    # 50 nodes do not fill the last of the 16-node block rows.
+    self._assert_bsr_matmul_matches(_random_graph(50, 400), 16)
+
+  def test_bsr_matmul_of_empty_adjacency(self):
+    adjacency = tf.SparseTensor(
+        tf.zeros((0, 2), tf.int64), tf.zeros((0,), tf.float32), (50, 50))
+    self._assert_bsr_matmul_matches(adjacency, 16)
+
+  def test_sparse_blocks_fall_back_to_sparse_dense_matmul(self):
+    adjacency = _random_graph(256, 64)
+    dense = tf.random.normal((256, 4))
+    with mock.patch.object(dmon, 'bsr_matmul') as bsr_matmul:
+      with self.assertWarnsRegex(UserWarning, 'block density'):
+        product = dmon._sparse_dense_matmul(adjacency, dense,
+                                            bsr_block_size=16)
+    bsr_matmul.assert_not_called()
+    self.assertAllClose(product,
+                        tf.sparse.sparse_dense_matmul(adjacency, dense))
+
+  def test_bf16_cannot_be_combined_with_bsr(self):
+    with self.assertRaises(ValueError):
+      dmon.DMoN(4, use_bf16=True, bsr_block_size=16)
+    with self.assertRaises(ValueError):
+      dmon._sparse_dense_matmul(_random_graph(8, 8), tf.ones((8, 2)),
+                                use_bf16=True, bsr_block_size=16)
+
+  def test_orthogonal_kernel_follows_tf_seed(self):
+    dmon._orthogonal_kernel.cache_clear()
+    tf.random.set_seed(0)
+    kernel = dmon._orthogonal_kernel(6, 3)
+    dmon._orthogonal_kernel.cache_clear()
+    tf.random.set_seed(0)
+    self.assertAllEqual(kernel, dmon._orthogonal_kernel(6, 3))
+    self.assertAllClose(kernel.T @ kernel, np.eye(3), atol=1e-6)
+
+  def test_tensor_lamda_matches_python_lamda(self):
+    n_nodes, n_features = 32, 4
+    features = tf.random.normal((n_nodes, n_features))
+    graphs = [_random_graph(n_nodes, 64, seed=seed) for seed in range(3)]
+    for layer_class, n_graphs in ((dmon.diverseDMoN, 2), (dmon.fairDMoN, 3),
+                                  (dmon.groupDMoN, 2)):
+      layer = layer_class(4)
+      inputs = [features] + graphs[:n_graphs]
+      for lamda in (0, 0.5, 1):
+        with self.subTest(layer=layer_class.__name__, lamda=lamda):
+          layer(inputs, lamda)
+          python_loss = tf.add_n(layer.losses)
+          layer(inputs, tf.constant(lamda, tf.float32))
+          self.assertAllClose(python_loss, tf.add_n(layer.losses))
+
+  @unittest.skipUnless(_HAS_NUMBA, 'requires numba')
+  def test_numba_kernels_match_numpy(self):
+    from tools import _dmon_kernels  # pylint: disable=g-import-not-at-top
+    rng = np.random.default_rng(0)
+    pooled_adjacency = rng.random((50, 6))
+    assignments = rng.random((50, 6))
+    degrees = rng.random(50)
+    self.assertAllClose(
+        _dmon_kernels.trace_stAs(pooled_adjacency, assignments),
+        np.sum(pooled_adjacency * assignments))
+    self.assertAllClose(
+        _dmon_kernels.norm_sq_std(assignments, degrees),
+        np.sum((assignments.T @ degrees)**2))
+
+  @unittest.skipUnless(_HAS_NUMBA, 'requires numba')
+  def test_numba_reduce_matches_xla_reduce(self):
+    n_nodes, n_features = 64, 8
+    inputs = [tf.random.normal((n_nodes, n_features)),
+              _random_graph(n_nodes, 256)]
+    xla_layer = dmon.DMoN(6)
+    xla_layer(inputs, training=False)
+    numba_layer = dmon.DMoN(6, use_numba_reduce=True)
+    numba_layer(inputs, training=False)
+    numba_layer.set_weights(xla_layer.get_weights())
+    with mock.patch.object(dmon, '_numba_modularity_reduce',
+                           wraps=dmon._numba_modularity_reduce) as reduce:
+      numba_layer(inputs, training=False)
+    reduce.assert_called_once()
+    self.assertAllClose(xla_layer.losses, numba_layer.losses)
+
+  def test_modularity_term_matches_explicit_formula(self):
+    n_nodes, n_clusters = 40, 5
+    rng = np.random.default_rng(3)
+    graph = _random_graph(n_nodes, 120)
+    adjacency = tf.SparseTensor(
+        graph.indices, rng.uniform(0.5, 3, graph.values.shape).astype(
+            np.float32), graph.dense_shape)
+    adjacency = tf.sparse.add(adjacency, tf.sparse.transpose(adjacency))
+    assignments = tf.nn.softmax(tf.random.normal((n_nodes, n_clusters)))
+    degrees = tf.reshape(tf.sparse.reduce_sum(adjacency, axis=0), (-1, 1))
+    number_of_edges = tf.reduce_sum(degrees)
+    modularity_number_of_edges = 1.7 * number_of_edges
+
+    pooled_graph = tf.matmul(
+        assignments, tf.sparse.sparse_dense_matmul(adjacency, assignments),
+        transpose_a=True)
+    normalizer = tf.matmul(
+        tf.matmul(assignments, degrees, transpose_a=True),
+        tf.matmul(degrees, assignments, transpose_a=True)) / 2 / number_of_edges
+    expected = -tf.linalg.trace(pooled_graph - normalizer) / 2 / (
+        modularity_number_of_edges)
+    self.assertAllClose(
+        dmon._modularity_term(adjacency, assignments, degrees, number_of_edges,
+                              modularity_number_of_edges), expected)
+
+if __name__ == '__main__':
+  tf.test.main()
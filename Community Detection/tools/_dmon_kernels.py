@@ -0,0 +1,49 @@
+"""Numba kernels for the dense tail of the DMoN spectral loss on CPU.
+
+After the sparse-dense product A*S, the spectral loss only needs two scalar
+reductions. In eager CPU inference TF dispatches them as several tiny ops;
+these kernels compute each one in a single parallel loop over NumPy arrays.
+They are not differentiable and are only used outside of training.
+"""
+import numba
+import numpy as np
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def trace_stAs(pooled_adjacency, assignments):
+  """Returns Tr(S^T*A*S) as the sum of (A*S)_ij * S_ij.
+
+  Args:
+    pooled_adjacency: (n*k) product A*S.
+    assignments: (n*k) soft cluster assignment matrix S.
+
+  Returns:
+    The trace as a float.
+  """
+  n_nodes, n_clusters = assignments.shape
+  total = 0.0
+  for i in numba.prange(n_nodes):
+    for j in range(n_clusters):
+      total += pooled_adjacency[i, j] * assignments[i, j]
+  return total
+
+
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def norm_sq_std(assignments, degrees):
+  """Returns the squared norm of S^T*d.
+
+  Args:
+    assignments: (n*k) soft cluster assignment matrix S.
+    degrees: (n,) degree vector d.
+
+  Returns:
+    ||S^T*d||^2 as a float.
+  """
+  n_nodes, n_clusters = assignments.shape
+  cluster_degrees = np.zeros(n_clusters)
+  for j in numba.prange(n_clusters):
+    cluster_degree = 0.0
+    for i in range(n_nodes):
+      cluster_degree += assignments[i, j] * degrees[i]
+    cluster_degrees[j] = cluster_degree
+  return np.sum(cluster_degrees * cluster_degrees)
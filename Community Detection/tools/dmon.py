@@ -14,9 +14,402 @@
 # limitations under the License.
 
 
+import collections
+import functools
+import numbers
+import warnings
+import weakref
+
+import numpy as np
+import scipy.sparse
 import tensorflow.compat.v2 as tf
 
 
+# Per-adjacency values derived in eager mode. See _cached_per_adjacency.
+_CSR_ADJACENCY_CACHE = {}
+_DEGREES_CACHE = {}
+_BFLOAT16_ADJACENCY_CACHE = {}
+_BSR_ADJACENCY_CACHES = collections.defaultdict(dict)
+
+
+def _cached_per_adjacency(cache, adjacency, compute):
+  """Returns compute(adjacency), memoized in `cache` when running eagerly.
+
+  Training loops feed the same graph on every step, so in eager mode the values
+  derived from an adjacency matrix are computed once per matrix instead of once
+  per step. Keras functional models rebuild every SparseTensor input on each
+  call (through a same-dtype tf.cast), but keep its indices and values tensors,
+  so entries are keyed by those two tensors rather than by the SparseTensor.
+  The entries only hold weak references to them and are dropped together with
+  the graph. Symbolic tensors cannot outlive their graph and are never cached.
+  """
+  if not tf.executing_eagerly():
+    return compute(adjacency)
+  indices, values = adjacency.indices, adjacency.values
+  key = (id(indices), id(values))
+  entry = cache.get(key)
+  if entry is not None and entry[0]() is indices and entry[1]() is values:
+    return entry[2]
+  value = compute(adjacency)
+  drop_entry = lambda _: cache.pop(key, None)
+  cache[key] = (weakref.ref(indices, drop_entry),
+                weakref.ref(values, drop_entry), value)
+  return value
+
+
+def _sparse_tensor_to_csr(adjacency):
+  ordered_adjacency = tf.sparse.reorder(adjacency)
+  return tf.raw_ops.SparseTensorToCSRSparseMatrix(
+      indices=ordered_adjacency.indices,
+      values=ordered_adjacency.values,
+      dense_shape=ordered_adjacency.dense_shape)
+
+
+def _to_csr(adjacency):
+  """Converts a sparse adjacency matrix to a (cached) CSRSparseMatrix."""
+  return _cached_per_adjacency(_CSR_ADJACENCY_CACHE, adjacency,
+                               _sparse_tensor_to_csr)
+
+
+def bsr_from_coo(indices, values, shape, block_size=16):
+  """Converts a square COO matrix to block-CSR (BSR) form.
+
+  The matrix is zero-padded to a multiple of `block_size` and split into
+  (block_size*block_size) dense blocks, of which only the non-empty ones are
+  stored.
+
+  Args:
+    indices: (nnz*2) NumPy array of row and column indices.
+    values: (nnz) NumPy array of values.
+    shape: Shape (n, n) of the matrix.
+    block_size: Side length of the dense blocks.
+
+  Returns:
+    A tuple (block_rows, block_columns, block_values, n_block_rows) where
+    block_rows and block_columns are the (nnzb) block coordinates, block_values
+    is the (nnzb*block_size*block_size) tensor of blocks and n_block_rows is
+    the number of block rows of the padded matrix.
+  """
+  n_block_rows = -(-int(shape[0]) // block_size)
+  padded_size = n_block_rows * block_size
+  matrix = scipy.sparse.coo_matrix(
+      (values, (indices[:, 0], indices[:, 1])),
+      shape=(padded_size, padded_size)).tobsr(blocksize=(block_size,
+                                                         block_size))
+  matrix.sum_duplicates()
+  block_rows = np.repeat(np.arange(n_block_rows), np.diff(matrix.indptr))
+  return (tf.constant(block_rows), tf.constant(matrix.indices),
+          tf.constant(matrix.data, dtype=tf.as_dtype(values.dtype)),
+          n_block_rows)
+
+
+def bsr_matmul(block_rows, block_columns, block_values, n_block_rows, dense):
+  """Multiplies a BSR matrix from bsr_from_coo by an (n*k) dense matrix.
+
+  Every stored block is multiplied with the matching (block_size*k) slice of
+  `dense` in one batched dense matmul, and the products are summed per block
+  row. The computation is plain TF, so it runs on CPU and GPU and is
+  differentiable with respect to `dense`.
+  """
+  block_size = block_values.shape[-1]
+  n_nodes = tf.shape(dense)[0]
+  dense_blocks = tf.reshape(
+      tf.pad(dense, [[0, n_block_rows * block_size - n_nodes], [0, 0]]),
+      (n_block_rows, block_size, -1))
+  products = tf.matmul(block_values, tf.gather(dense_blocks, block_columns))
+  product = tf.math.unsorted_segment_sum(products, block_rows, n_block_rows)
+  return tf.reshape(product, (n_block_rows * block_size, -1))[:n_nodes]
+
+
+# Minimum fraction of nonzeros in the stored blocks for which the BSR form is
+# used. Each block stores block_size^2 values, so below this density its memory
+# exceeds about twice that of the COO form and the product does mostly
+# multiplications by zero.
+_BSR_MIN_BLOCK_DENSITY = 0.1
+
+
+def _sparse_tensor_to_bsr(adjacency, block_size):
+  """Returns the BSR tensors of `adjacency`, or None if too sparse per block."""
+  indices = adjacency.indices.numpy()
+  n_block_rows = -(-int(adjacency.dense_shape[0]) // block_size)
+  n_blocks = len(np.unique(
+      indices[:, 0] // block_size * n_block_rows + indices[:, 1] // block_size))
+  if n_blocks and len(indices) < (_BSR_MIN_BLOCK_DENSITY * n_blocks *
+                                  block_size * block_size):
+    warnings.warn(
+        f'Adjacency matrix has {len(indices)} nonzeros in {n_blocks} blocks of '
+        f'size {block_size}, below the minimum block density of '
+        f'{_BSR_MIN_BLOCK_DENSITY}. Falling back to sparse_dense_matmul.')
+    return None
+  return bsr_from_coo(indices, adjacency.values.numpy(),
+                      adjacency.dense_shape.numpy(), block_size)
+
+
+def _to_bsr(adjacency, block_size):
+  """Converts an eager sparse adjacency matrix to (cached) BSR tensors.
+
+  Returns None, once per matrix, if its nonzeros are too scattered for blocks
+  of `block_size`, see _BSR_MIN_BLOCK_DENSITY.
+  """
+  return _cached_per_adjacency(
+      _BSR_ADJACENCY_CACHES[block_size], adjacency,
+      functools.partial(_sparse_tensor_to_bsr, block_size=block_size))
+
+
+# Number of dense columns from which sparse-dense products with use_csr go
+# through the CSR SparseMatrixMatMul kernel (cuSPARSE SpMM on GPU). On CPU, for
+# a 20000-node graph with 200k nonzeros, the CSR kernel was 1.5-2x slower than
+# SparseTensorDenseMatMul for 2 and 4 columns, and within run-to-run noise of it
+# (0.9-1.4x) from 8 to 64 columns. 16 keeps a margin above that crossover; the
+# GPU crossover has not been measured.
+_CSR_MATMUL_MIN_COLUMNS = 16
+
+
+def _check_product_options(use_bf16, bsr_block_size, use_csr):
+  """Raises a ValueError if use_bf16 is combined with another product option."""
+  if use_bf16 and (bsr_block_size or use_csr):
+    raise ValueError('DMoN use_bf16 cannot be combined with bsr_block_size or '
+                     'use_csr')
+
+
+def _sparse_dense_matmul(adjacency, dense, use_bf16=False,
+                         bsr_block_size=None, use_csr=False):
+  """Multiplies an (n*n) sparse adjacency matrix by an (n*k) dense matrix.
+
+  Args:
+    adjacency: (n*n) sparse graph adjacency matrix.
+    dense: (n*k) dense matrix.
+    use_bf16: If True, both operands are read in bfloat16 to halve the memory
+      traffic of the product, and the result is cast back to the dtype of
+      `dense`. Neither the CSR kernel nor bsr_matmul is used in bfloat16, so
+      this uses the default sparse-dense kernel and is mutually exclusive
+      with the other two options.
+    bsr_block_size: If set, eager products go through the block-sparse
+      bsr_matmul with blocks of this size. Graphs with community structure
+      have few, dense blocks, for which this is close to dense throughput.
+      The BSR form is built with NumPy, so in graph mode, and for matrices
+      whose blocks are too sparse, the product falls through to the next
+      option.
+    use_csr: If True, products with at least _CSR_MATMUL_MIN_COLUMNS columns go
+      through the CSR SparseMatrixMatMul kernel. It only pays off on GPU and
+      when the CSR conversion is cached, i.e. in eager mode; in graph mode the
+      conversion runs on every step.
+
+  Returns:
+    The (n*k) dense product.
+
+  Raises:
+    ValueError: If use_bf16 is combined with bsr_block_size or use_csr.
+  """
+  _check_product_options(use_bf16, bsr_block_size, use_csr)
+  if use_bf16:
+    bfloat16_adjacency = _cached_per_adjacency(
+        _BFLOAT16_ADJACENCY_CACHE, adjacency,
+        lambda adjacency: tf.cast(adjacency, tf.bfloat16))
+    product = tf.sparse.sparse_dense_matmul(bfloat16_adjacency,
+                                            tf.cast(dense, tf.bfloat16))
+    return tf.cast(product, dense.dtype)
+  if bsr_block_size and tf.executing_eagerly():
+    bsr_adjacency = _to_bsr(adjacency, bsr_block_size)
+    if bsr_adjacency is not None:
+      return bsr_matmul(*bsr_adjacency, dense)
+  n_columns = dense.shape[-1]
+  if (use_csr and n_columns is not None and
+      n_columns >= _CSR_MATMUL_MIN_COLUMNS):
+    return tf.raw_ops.SparseMatrixMatMul(a=_to_csr(adjacency), b=dense)
+  return tf.sparse.sparse_dense_matmul(adjacency, dense)
+
+
+def _sparse_degrees(adjacency):
+  degrees = tf.reshape(tf.sparse.reduce_sum(adjacency, axis=0), (-1, 1))
+  return degrees, tf.math.reduce_sum(degrees)
+
+
+def _degrees(adjacency, degrees=None):
+  """Returns the (n*1) degree vector of a graph and the sum of its entries.
+
+  Args:
+    adjacency: (n*n) sparse graph adjacency matrix.
+    degrees: Optional precomputed (n*1) degree vector of `adjacency`, e.g. for
+      graphs that change between steps.
+
+  Returns:
+    A tuple (degrees, number_of_edges).
+  """
+  if degrees is not None:
+    degrees = tf.reshape(degrees, (-1, 1))
+    return degrees, tf.math.reduce_sum(degrees)
+  return _cached_per_adjacency(_DEGREES_CACHE, adjacency, _sparse_degrees)
+
+
+def _is_static_weight(lamda, value):
+  """Returns True if the loss weight `lamda` is a Python number equal to value.
+
+  Only such weights let a loss branch be skipped at trace time. Tensor weights
+  keep both branches in the graph and zero out the unused one by
+  multiplication, so changing lamda never retraces the layer.
+  """
+  return isinstance(lamda, numbers.Real) and lamda == value
+
+
+@functools.lru_cache(maxsize=None)
+def _orthogonal_kernel(n_features, n_clusters):
+  """Returns a (n_features*n_clusters) orthogonal matrix for the transform.
+
+  The QR decomposition is done once per shape, so rebuilding layers of the same
+  shape, e.g. across folds or hyperparameter sweeps, reuses the same (read-only)
+  initial kernel instead of drawing and decomposing a new one. The matrix is
+  drawn with tf.random, so tf.random.set_seed makes it reproducible, but only
+  the seed in effect when the first layer of a shape is built matters.
+  """
+  flat_shape = (max(n_features, n_clusters), min(n_features, n_clusters))
+  q, r = np.linalg.qr(
+      tf.random.normal(flat_shape, dtype=tf.float64).numpy())
+  q *= np.sign(np.diag(r))
+  if n_features < n_clusters:
+    q = q.T
+  q = q.astype(np.float32)
+  q.setflags(write=False)
+  return q
+
+
+def _modularity_scales(number_of_edges, modularity_number_of_edges):
+  """Returns the factors of Tr(S^T*A*S) and ||S^T*d||^2 in the spectral loss.
+
+  The loss -(Tr(S^T*A*S) - ||S^T*d||^2 / 2m) / 2m_mod is evaluated as a
+  difference of two scaled reductions, so each reduction is followed by a
+  single multiply instead of a chain of divisions.
+  """
+  trace_scale = 1 / (2 * modularity_number_of_edges)
+  return trace_scale, trace_scale / (2 * number_of_edges)
+
+
+def _build_transform(n_features, n_clusters, dropout_rate):
+  """Builds the Dense + Dropout transform from features to cluster logits."""
+  return tf.keras.models.Sequential([
+      tf.keras.layers.Dense(
+          n_clusters,
+          kernel_initializer=tf.constant_initializer(
+              _orthogonal_kernel(n_features, n_clusters)),
+          bias_initializer='zeros'),
+      tf.keras.layers.Dropout(dropout_rate)
+  ])
+
+
+def _collapse_loss_scale(n_nodes, n_clusters):
+  """Returns the sqrt(k) / n factor of the collapse regularization.
+
+  It only depends on static sizes, so layers fold it into one constant at build
+  time instead of computing it on every call.
+  """
+  return tf.constant(float(np.sqrt(n_clusters)) / float(n_nodes))
+
+
+def _pool_features(features, assignments, cluster_sizes, do_unpooling):
+  """Pools (n*d) features into (k*d) cluster representations, see DMoN.call."""
+  # Pooling with S/c is done as diag(1/c)*S^T*X, so the cluster sizes scale
+  # the [k, d] product instead of the [n, k] assignment matrix.
+  features_pooled = tf.matmul(
+      assignments, features, transpose_a=True) / cluster_sizes[:, None]
+  features_pooled = tf.nn.selu(features_pooled)
+  if do_unpooling:
+    features_pooled = tf.matmul(assignments,
+                                features_pooled / cluster_sizes[:, None])
+  return features_pooled
+
+
+@tf.function(jit_compile=True, reduce_retracing=True)
+def _modularity_reduce(pooled_adjacency, assignments, degrees, number_of_edges,
+                       modularity_number_of_edges):
+  """Reduces A*S to the spectral loss as a single XLA-compiled kernel.
+
+  Sparse-dense multiplication has no XLA kernel, so the product A*S is taken
+  outside of this function and only the dense epilogue is compiled.
+  """
+  trace_scale, normalizer_scale = _modularity_scales(
+      number_of_edges, modularity_number_of_edges)
+
+  # Tr(S^T*A*S) is the elementwise contraction of A*S with S, so the [k, k]
+  # pooled graph never needs to be formed.
+  graph_pooled_trace = tf.reduce_sum(pooled_adjacency * assignments)
+
+  # The normalizer S^T*d*d^T*S is the outer product of the [k, 1] tensor S^T*d
+  # with its transpose d^T*S, so S^T*d is computed once and the trace is its
+  # squared norm.
+  cluster_degrees = tf.matmul(assignments, degrees, transpose_a=True)
+  normalizer_trace = tf.reduce_sum(tf.square(cluster_degrees))
+  return normalizer_scale * normalizer_trace - trace_scale * graph_pooled_trace
+
+
+def _numba_modularity_reduce(pooled_adjacency, assignments, degrees,
+                             number_of_edges, modularity_number_of_edges):
+  """Eager, non-differentiable counterpart of _modularity_reduce using Numba."""
+  from tools import _dmon_kernels  # Numba is only needed when this is enabled.
+  trace_scale, normalizer_scale = _modularity_scales(
+      float(number_of_edges), float(modularity_number_of_edges))
+  assignments_array = assignments.numpy()
+  graph_pooled_trace = _dmon_kernels.trace_stAs(pooled_adjacency.numpy(),
+                                                assignments_array)
+  normalizer_trace = _dmon_kernels.norm_sq_std(assignments_array,
+                                               degrees.numpy().ravel())
+  return tf.constant(
+      normalizer_scale * normalizer_trace - trace_scale * graph_pooled_trace,
+      dtype=assignments.dtype)
+
+
+def _modularity_term(adjacency, assignments, degrees, number_of_edges,
+                     modularity_number_of_edges, use_bf16=False,
+                     use_numba_reduce=False, bsr_block_size=None,
+                     use_csr=False):
+  """Computes the spectral (negative modularity) loss of one adjacency matrix.
+
+  Args:
+    adjacency: (n*n) sparse graph adjacency matrix.
+    assignments: (n*k) soft cluster assignment matrix.
+    degrees: (n*1) degree vector of `adjacency`.
+    number_of_edges: Sum of `degrees`, used to scale the rank-1 normalizer.
+    modularity_number_of_edges: Sum of the degrees of the original graph, used
+      to scale the resulting loss.
+    use_bf16: Whether to compute A*S in bfloat16, see _sparse_dense_matmul.
+    use_numba_reduce: Whether to reduce A*S with the Numba kernels when running
+      eagerly and A*S is on CPU. The result carries no gradient, so this is for
+      inference only.
+    bsr_block_size: Optional block size for a block-sparse A*S, see
+      _sparse_dense_matmul.
+    use_csr: Whether to compute A*S with the CSR kernel, see
+      _sparse_dense_matmul.
+
+  Returns:
+    A scalar -Tr(S^T*A*S - S^T*d*d^T*S / 2m) / 2m_mod.
+  """
+  pooled_adjacency = _sparse_dense_matmul(adjacency, assignments, use_bf16,
+                                          bsr_block_size, use_csr)
+  if (use_numba_reduce and tf.executing_eagerly() and
+      tf.DeviceSpec.from_string(pooled_adjacency.device).device_type == 'CPU'):
+    return _numba_modularity_reduce(pooled_adjacency, assignments, degrees,
+                                    number_of_edges, modularity_number_of_edges)
+  return _modularity_reduce(pooled_adjacency, assignments, degrees,
+                            number_of_edges, modularity_number_of_edges)
+
+
+def _modularity_term_fn(layer, training):
+  """Returns _modularity_term bound to the loss options of a DMoN layer.
+
+  Args:
+    layer: A DMoN layer (or variant) with the use_bf16, use_numba_reduce,
+      bsr_block_size and use_csr attributes.
+    training: The `training` argument of the layer call. The Numba reduction
+      carries no gradient, so it is only enabled when this is False.
+
+  Returns:
+    A function of (adjacency, assignments, degrees, number_of_edges,
+    modularity_number_of_edges).
+  """
+  return functools.partial(
+      _modularity_term, use_bf16=layer.use_bf16,
+      use_numba_reduce=layer.use_numba_reduce and training is False,
+      bsr_block_size=layer.bsr_block_size, use_csr=layer.use_csr)
+
 
 class DMoN(tf.keras.layers.Layer):
   """Implementation of Deep Modularity Network (DMoN) layer.
@@ -35,38 +428,74 @@ class DMoN(tf.keras.layers.Layer):
     do_unpooling: Parameter controlling whether to perform unpooling of the
       features with respect to their soft clusters. If true, shape of the input
       is preserved.
+    use_bf16: Whether to compute the sparse-dense products of the loss in
+      bfloat16. Softmax, cluster sizes and the loss reductions stay in float32.
+      Cannot be combined with bsr_block_size or use_csr.
+    use_numba_reduce: Whether to compute the dense tail of the spectral loss
+      with Numba kernels in eager inference, i.e. when called with
+      training=False and the product A*S is on CPU. Requires numba to be
+      installed.
+    bsr_block_size: Optional block size. If set, eager sparse-dense products
+      use a block-CSR representation of the adjacency matrices, which suits
+      graphs with dense community blocks. Products traced in graph mode, and
+      matrices whose blocks are mostly empty (with a warning), use the
+      SparseTensorDenseMatMul kernel, or CSR if use_csr is set.
+    use_csr: Whether sparse-dense products with at least
+      _CSR_MATMUL_MIN_COLUMNS clusters use the CSR SparseMatrixMatMul kernel
+      (cuSPARSE SpMM on GPU). In eager mode the CSR form of each adjacency
+      matrix is converted once and cached; in graph mode it is converted on
+      every step. By default the SparseTensorDenseMatMul kernel is used.
+    transform: Optional Keras layer mapping (n*d) features to (n*k) cluster
+      logits. Passing the same layer to several DMoN layers shares its weights.
+      By default a new Dense + Dropout transform is built for each layer.
+      Its orthogonal initial kernel is drawn once per (d, k) shape and process,
+      so all default transforms of the same shape start from identical
+      weights, and tf.random.set_seed only affects it before the first of them
+      is built.
   """
 
   def __init__(self,
                n_clusters,
                collapse_regularization = 0.1,
                dropout_rate = 0,
-               do_unpooling = False):
+               do_unpooling = False,
+               use_bf16 = False,
+               use_numba_reduce = False,
+               bsr_block_size = None,
+               use_csr = False,
+               transform = None):
     """Initializes the layer with specified parameters."""
     super(DMoN, self).__init__()
     self.n_clusters = n_clusters
     self.collapse_regularization = collapse_regularization
     self.dropout_rate = dropout_rate
     self.do_unpooling = do_unpooling
+    self.use_bf16 = use_bf16
+    self.use_numba_reduce = use_numba_reduce
+    self.bsr_block_size = bsr_block_size
+    self.use_csr = use_csr
+    _check_product_options(use_bf16, bsr_block_size, use_csr)
+    self.transform = transform
 
   def build(self, input_shape):
     """Builds the Keras model according to the input shape."""
-    self.transform = tf.keras.models.Sequential([
-        tf.keras.layers.Dense(
-            self.n_clusters,
-            kernel_initializer='orthogonal',
-            bias_initializer='zeros'),
-        tf.keras.layers.Dropout(self.dropout_rate)
-    ])
+    if self.transform is None:
+      self.transform = _build_transform(
+          int(input_shape[0][-1]), self.n_clusters, self.dropout_rate)
+    self._collapse_scale = _collapse_loss_scale(input_shape[1][1],
+                                                self.n_clusters)
     super(DMoN, self).build(input_shape)
 
   def call(
-      self, inputs):
+      self, inputs, *, degrees=None, training=None):
     """Performs DMoN clustering according to input features and input graph.
 
     Args:
       inputs: A tuple of Tensorflow tensors. First element is (n*d) node feature
         matrix and the second one is (n*n) sparse graph adjacency matrix.
+      degrees: Optional precomputed (n*1) degree vector of the adjacency matrix.
+        By default it is derived from the adjacency matrix and cached.
+      training: Whether the layer is called in training mode.
 
     Returns:
       A tuple (features, clusters) with (k*d) cluster representations and
@@ -76,76 +505,75 @@ class DMoN(tf.keras.layers.Layer):
       instead of cluster representations.
     """
     features, adjacency = inputs
+    modularity_term = _modularity_term_fn(self, training)
 
 
     assignments = tf.nn.softmax(self.transform(features), axis=1)
     
     cluster_sizes = tf.math.reduce_sum(assignments, axis=0)  
-    assignments_pooling = assignments / cluster_sizes  
-
-    degrees = tf.sparse.reduce_sum(adjacency, axis=0) 
-    degrees = tf.reshape(degrees, (-1, 1))
-
-    number_of_nodes = adjacency.shape[1]
-    number_of_edges = tf.math.reduce_sum(degrees)
-
 
-    graph_pooled = tf.transpose(
-        tf.sparse.sparse_dense_matmul(adjacency, assignments))
-    graph_pooled = tf.matmul(graph_pooled, assignments)
+    degrees, number_of_edges = _degrees(adjacency, degrees)
 
 
-    normalizer_left = tf.matmul(assignments, degrees, transpose_a=True)
-
-    normalizer_right = tf.matmul(degrees, assignments, transpose_a=True)
-
-    normalizer = tf.matmul(normalizer_left,
-                           normalizer_right) / 2 / number_of_edges
-    spectral_loss = -tf.linalg.trace(graph_pooled -
-                                     normalizer) / 2 / number_of_edges
+    spectral_loss = modularity_term(
+        adjacency, assignments, degrees, number_of_edges, number_of_edges)
     self.add_loss(spectral_loss)
 
-    collapse_loss = tf.norm(cluster_sizes) / number_of_nodes * tf.sqrt(
-        float(self.n_clusters)) - 1
+    collapse_loss = tf.sqrt(tf.reduce_sum(
+        tf.square(cluster_sizes))) * self._collapse_scale - 1
     self.add_loss(self.collapse_regularization * collapse_loss)
 
-    features_pooled = tf.matmul(assignments_pooling, features, transpose_a=True)
-    features_pooled = tf.nn.selu(features_pooled)
-    if self.do_unpooling:
-      features_pooled = tf.matmul(assignments_pooling, features_pooled)
+    features_pooled = _pool_features(features, assignments, cluster_sizes,
+                                     self.do_unpooling)
     return features_pooled, assignments
 
 class diverseDMoN(tf.keras.layers.Layer):
+  """DMoN layer whose spectral loss is mixed with that of a diversity graph.
+
+  Attributes are as in DMoN.
+  """
 
   def __init__(self,
                n_clusters,
                collapse_regularization = 0.1,
                dropout_rate = 0,
-               do_unpooling = False):
+               do_unpooling = False,
+               use_bf16 = False,
+               use_numba_reduce = False,
+               bsr_block_size = None,
+               use_csr = False,
+               transform = None):
     
     super(diverseDMoN, self).__init__()
     self.n_clusters = n_clusters
     self.collapse_regularization = collapse_regularization
     self.dropout_rate = dropout_rate
     self.do_unpooling = do_unpooling
+    self.use_bf16 = use_bf16
+    self.use_numba_reduce = use_numba_reduce
+    self.bsr_block_size = bsr_block_size
+    self.use_csr = use_csr
+    _check_product_options(use_bf16, bsr_block_size, use_csr)
+    self.transform = transform
 
   def build(self, input_shape):
     
-    self.transform = tf.keras.models.Sequential([
-        tf.keras.layers.Dense(
-            self.n_clusters,
-            kernel_initializer='orthogonal',
-            bias_initializer='zeros'),
-        tf.keras.layers.Dropout(self.dropout_rate)
-    ])
+    if self.transform is None:
+      self.transform = _build_transform(
+          int(input_shape[0][-1]), self.n_clusters, self.dropout_rate)
+    self._collapse_scale = _collapse_loss_scale(input_shape[1][1],
+                                                self.n_clusters)
     super(diverseDMoN, self).build(input_shape)
 
   def call(
-      self, inputs,lamda):
+      self, inputs,lamda, *, degrees=None, training=None):
 
     
 
     features, adjacency,diverce_adjacency = inputs
+    modularity_term = _modularity_term_fn(self, training)
+    # Optional precomputed degree vectors, one per adjacency matrix in inputs.
+    adjacency_degrees = (None,) * 2 if degrees is None else degrees
     
 
 
@@ -153,110 +581,87 @@ class diverseDMoN(tf.keras.layers.Layer):
 
     assignments = tf.nn.softmax(self.transform(features), axis=1)
     cluster_sizes = tf.math.reduce_sum(assignments, axis=0)  # Size [k].
-    assignments_pooling = assignments / cluster_sizes  # Size [n, k].
     
-    modularity_degrees = tf.sparse.reduce_sum(adjacency, axis=0)
-    modularity_number_of_edges = tf.math.reduce_sum(modularity_degrees)
+    modularity_degrees, modularity_number_of_edges = _degrees(
+        adjacency, adjacency_degrees[0])
 
 
     
     
 
-    if lamda != 0:
-      degrees = tf.sparse.reduce_sum(diverce_adjacency, axis=0)  # Size [n].
-      degrees = tf.reshape(degrees, (-1, 1))
-      
+    if not _is_static_weight(lamda, 0):
+      degrees, number_of_edges = _degrees(diverce_adjacency,
+                                          adjacency_degrees[1])
       
-      number_of_edges = tf.math.reduce_sum(degrees)
-      
-      diversity_graph_pooled = tf.transpose(
-          tf.sparse.sparse_dense_matmul(diverce_adjacency, assignments))
-      diversity_graph_pooled = tf.matmul(diversity_graph_pooled, assignments)
-
-      normalizer_left = tf.matmul(assignments, degrees, transpose_a=True)
-
-      normalizer_right = tf.matmul(degrees, assignments, transpose_a=True)
-
-
-      normalizer = tf.matmul(normalizer_left,
-                            normalizer_right) / 2 / number_of_edges
-      diversity_spectral_loss = -tf.linalg.trace(diversity_graph_pooled -
-                                      normalizer) / 2 / modularity_number_of_edges
+      diversity_spectral_loss = modularity_term(
+          diverce_adjacency, assignments, degrees, number_of_edges,
+          modularity_number_of_edges)
     
       self.add_loss(lamda*diversity_spectral_loss)
     
     
 
     
-    degrees = modularity_degrees  # Size [n].
-    degrees = tf.reshape(degrees, (-1, 1))
-
-    number_of_nodes = adjacency.shape[1]
     
     
-    if lamda != 1:
-      # Computes the size [k, k] pooled graph as S^T*A*S in two multiplications.
-      graph_pooled = tf.transpose(
-          tf.sparse.sparse_dense_matmul(adjacency, assignments))
-      graph_pooled = tf.matmul(graph_pooled, assignments)
-
-      # We compute the rank-1 normaizer matrix S^T*d*d^T*S efficiently
-      # in three matrix multiplications by first processing the left part S^T*d
-      # and then multyplying it by the right part d^T*S.
-      # Left part is [k, 1] tensor.
-      normalizer_left = tf.matmul(assignments, degrees, transpose_a=True)
-      # Right part is [1, k] tensor.
-      normalizer_right = tf.matmul(degrees, assignments, transpose_a=True)
-
-      # Normalizer is rank-1 correction for degree distribution for degrees of the
-      # nodes in the original graph, casted to the pooled graph.
-      normalizer = tf.matmul(normalizer_left,
-                            normalizer_right) / 2 / modularity_number_of_edges
-      spectral_loss = -tf.linalg.trace(graph_pooled -
-                                      normalizer) / 2 / modularity_number_of_edges
+    if not _is_static_weight(lamda, 1):
+      spectral_loss = modularity_term(
+          adjacency, assignments, modularity_degrees,
+          modularity_number_of_edges, modularity_number_of_edges)
     
       self.add_loss((1-lamda)*spectral_loss)
 
-    collapse_loss = tf.norm(cluster_sizes) / number_of_nodes * tf.sqrt(
-        float(self.n_clusters)) - 1
+    collapse_loss = tf.sqrt(tf.reduce_sum(
+        tf.square(cluster_sizes))) * self._collapse_scale - 1
     self.add_loss(self.collapse_regularization * collapse_loss)
 
-    features_pooled = tf.matmul(assignments_pooling, features, transpose_a=True)
-    features_pooled = tf.nn.selu(features_pooled)
-    if self.do_unpooling:
-      features_pooled = tf.matmul(assignments_pooling, features_pooled)
+    features_pooled = _pool_features(features, assignments, cluster_sizes,
+                                     self.do_unpooling)
     return features_pooled, assignments
   
   
   
   
 class fairDMoN(tf.keras.layers.Layer):
+  """DMoN layer penalizing the spectral loss gap between two group graphs.
+
+  Attributes are as in DMoN.
+  """
 
   def __init__(self,
                n_clusters,
                collapse_regularization = 0.1,
                dropout_rate = 0,
-               do_unpooling = False):
+               do_unpooling = False,
+               use_bf16 = False,
+               use_numba_reduce = False,
+               bsr_block_size = None,
+               use_csr = False,
+               transform = None):
     
     super(fairDMoN, self).__init__()
     self.n_clusters = n_clusters
     self.collapse_regularization = collapse_regularization
     self.dropout_rate = dropout_rate
     self.do_unpooling = do_unpooling
+    self.use_bf16 = use_bf16
+    self.use_numba_reduce = use_numba_reduce
+    self.bsr_block_size = bsr_block_size
+    self.use_csr = use_csr
+    _check_product_options(use_bf16, bsr_block_size, use_csr)
+    self.transform = transform
 
   def build(self, input_shape):
     
-    self.transform = tf.keras.models.Sequential([
-        tf.keras.layers.Dense(
-            self.n_clusters,
-            kernel_initializer='orthogonal',
-            bias_initializer='zeros'),
-        tf.keras.layers.Dropout(self.dropout_rate)
-    ])
+    if self.transform is None:
+      self.transform = _build_transform(
+          int(input_shape[0][-1]), self.n_clusters, self.dropout_rate)
+    self._collapse_scale = _collapse_loss_scale(input_shape[1][1],
+                                                self.n_clusters)
     super(fairDMoN, self).build(input_shape)
 
   def call(
-      self, inputs,lamda):
+      self, inputs,lamda, *, degrees=None, training=None):
 
       
       
@@ -266,6 +671,9 @@ class fairDMoN(tf.keras.layers.Layer):
     
 
     features, adjacency,red_adjacency,blue_adjacency = inputs
+    modularity_term = _modularity_term_fn(self, training)
+    # Optional precomputed degree vectors, one per adjacency matrix in inputs.
+    adjacency_degrees = (None,) * 3 if degrees is None else degrees
     
 
     
@@ -274,96 +682,59 @@ class fairDMoN(tf.keras.layers.Layer):
 
 
 
+    # The (n*k) assignments are bound once and shared by the red, blue and
+    # modularity products and by the pooling. The XLA loss epilogue receives
+    # them as an argument, so they are never recomputed from the softmax.
     assignments = tf.nn.softmax(self.transform(features), axis=1)
     cluster_sizes = tf.math.reduce_sum(assignments, axis=0)  # Size [k].
-    assignments_pooling = assignments / cluster_sizes  # Size [n, k].
     
     
-    modularity_degrees = tf.sparse.reduce_sum(adjacency, axis=0)  # Size [n].
-    modularity_number_of_edges = tf.math.reduce_sum(modularity_degrees)
+    modularity_degrees, modularity_number_of_edges = _degrees(
+        adjacency, adjacency_degrees[0])
     
 
     
     
     
     
-    if lamda !=0:
+    if not _is_static_weight(lamda, 0):
       #red loss
 
-      degrees = tf.sparse.reduce_sum(red_adjacency, axis=0)  # Size [n].
-      degrees = tf.reshape(degrees, (-1, 1))
-      number_of_edges = tf.math.reduce_sum(degrees)
+      degrees, number_of_edges = _degrees(red_adjacency, adjacency_degrees[1])
   
-      red_graph_pooled = tf.transpose(
-          tf.sparse.sparse_dense_matmul(red_adjacency, assignments))
-      red_graph_pooled = tf.matmul(red_graph_pooled, assignments)
-
-      normalizer_left = tf.matmul(assignments, degrees, transpose_a=True)
-      normalizer_right = tf.matmul(degrees, assignments, transpose_a=True)
-      
-      normalizer = tf.matmul(normalizer_left,
-                            normalizer_right) / 2 / number_of_edges
-      red_spectral_loss = -tf.linalg.trace(red_graph_pooled -
-                                      normalizer) / 2 / modularity_number_of_edges
+      red_spectral_loss = modularity_term(
+          red_adjacency, assignments, degrees, number_of_edges,
+          modularity_number_of_edges)
       
       
       #blue loss
       
-      degrees = tf.sparse.reduce_sum(blue_adjacency, axis=0)  # Size [n].
-      degrees = tf.reshape(degrees, (-1, 1))
-      number_of_edges = tf.math.reduce_sum(degrees)
+      degrees, number_of_edges = _degrees(blue_adjacency, adjacency_degrees[2])
       
       
-      blue_graph_pooled = tf.transpose(
-          tf.sparse.sparse_dense_matmul(blue_adjacency, assignments))
-      blue_graph_pooled = tf.matmul(blue_graph_pooled, assignments)
-
-      normalizer_left = tf.matmul(assignments, degrees, transpose_a=True)
-
-      normalizer_right = tf.matmul(degrees, assignments, transpose_a=True)
-
-      normalizer = tf.matmul(normalizer_left,
-                            normalizer_right) / 2 / number_of_edges
-      blue_spectral_loss = -tf.linalg.trace(blue_graph_pooled -
-                                      normalizer) / 2 / modularity_number_of_edges
+      blue_spectral_loss = modularity_term(
+          blue_adjacency, assignments, degrees, number_of_edges,
+          modularity_number_of_edges)
       
       fairness_spectral_loss = red_spectral_loss - blue_spectral_loss
       
       
       self.add_loss(tf.abs(lamda *fairness_spectral_loss))
     
-    if lamda != 1:
+    if not _is_static_weight(lamda, 1):
       #modularity loss
-      
-      degrees = modularity_degrees  # Size [n].
-      degrees = tf.reshape(degrees, (-1, 1))
-
-      
-
-
-
-      graph_pooled = tf.transpose(
-          tf.sparse.sparse_dense_matmul(adjacency, assignments))
-      graph_pooled = tf.matmul(graph_pooled, assignments)
-
-      normalizer_left = tf.matmul(assignments, degrees, transpose_a=True)
-
-      normalizer_right = tf.matmul(degrees, assignments, transpose_a=True)
-      
-      normalizer = tf.matmul(normalizer_left,
-                            normalizer_right) / 2 / modularity_number_of_edges
-      spectral_loss = -tf.linalg.trace(graph_pooled -
-                                      normalizer) / 2 / modularity_number_of_edges
+      spectral_loss = modularity_term(
+          adjacency, assignments, modularity_degrees,
+          modularity_number_of_edges, modularity_number_of_edges)
+      # The modularity loss is unweighted, it is only dropped for lamda == 1.
+      spectral_loss *= tf.cast(tf.not_equal(lamda, 1), spectral_loss.dtype)
       self.add_loss(spectral_loss)
-    number_of_nodes = adjacency.shape[1]
-    collapse_loss = tf.norm(cluster_sizes) / number_of_nodes * tf.sqrt(
-        float(self.n_clusters)) - 1
+    collapse_loss = tf.sqrt(tf.reduce_sum(
+        tf.square(cluster_sizes))) * self._collapse_scale - 1
     self.add_loss(self.collapse_regularization * collapse_loss)
 
-    features_pooled = tf.matmul(assignments_pooling, features, transpose_a=True)
-    features_pooled = tf.nn.selu(features_pooled)
-    if self.do_unpooling:
-      features_pooled = tf.matmul(assignments_pooling, features_pooled)
+    features_pooled = _pool_features(features, assignments, cluster_sizes,
+                                     self.do_unpooling)
     return features_pooled, assignments
   
   
@@ -373,71 +744,74 @@ class fairDMoN(tf.keras.layers.Layer):
 
   
 class groupDMoN(tf.keras.layers.Layer):
+  """DMoN layer whose spectral loss is mixed with that of a group graph.
 
+  Attributes are as in DMoN.
+  """
 
   def __init__(self,
                n_clusters,
                collapse_regularization = 0.1,
                dropout_rate = 0,
-               do_unpooling = False):
+               do_unpooling = False,
+               use_bf16 = False,
+               use_numba_reduce = False,
+               bsr_block_size = None,
+               use_csr = False,
+               transform = None):
     
     super(groupDMoN, self).__init__()
     self.n_clusters = n_clusters
     self.collapse_regularization = collapse_regularization
     self.dropout_rate = dropout_rate
     self.do_unpooling = do_unpooling
+    self.use_bf16 = use_bf16
+    self.use_numba_reduce = use_numba_reduce
+    self.bsr_block_size = bsr_block_size
+    self.use_csr = use_csr
+    _check_product_options(use_bf16, bsr_block_size, use_csr)
+    self.transform = transform
 
   def build(self, input_shape):
     
-    self.transform = tf.keras.models.Sequential([
-        tf.keras.layers.Dense(
-            self.n_clusters,
-            kernel_initializer='orthogonal',
-            bias_initializer='zeros'),
-        tf.keras.layers.Dropout(self.dropout_rate)
-    ])
+    if self.transform is None:
+      self.transform = _build_transform(
+          int(input_shape[0][-1]), self.n_clusters, self.dropout_rate)
+    self._collapse_scale = _collapse_loss_scale(input_shape[1][1],
+                                                self.n_clusters)
     super(groupDMoN, self).build(input_shape)
 
-  def call(self, inputs,lamda):
+  def call(self, inputs,lamda, *, degrees=None, training=None):
     
 
 
     features, adjacency,red_adjacency = inputs
+    modularity_term = _modularity_term_fn(self, training)
+    # Optional precomputed degree vectors, one per adjacency matrix in inputs.
+    adjacency_degrees = (None,) * 2 if degrees is None else degrees
     
     assignments = tf.nn.softmax(self.transform(features), axis=1)
     cluster_sizes = tf.math.reduce_sum(assignments, axis=0)  # Size [k].
-    assignments_pooling = assignments / cluster_sizes  # Size [n, k].
  
-    modularity_degrees = tf.sparse.reduce_sum(adjacency, axis=0)  # Size [n].
-    modularity_number_of_edges = tf.math.reduce_sum(modularity_degrees)
+    modularity_degrees, modularity_number_of_edges = _degrees(
+        adjacency, adjacency_degrees[0])
     
 
     
     
     
     
-    if lamda !=0:
+    if not _is_static_weight(lamda, 0):
       #red loss
 
-      degrees = tf.sparse.reduce_sum(red_adjacency, axis=0)  # Size [n].
-      degrees = tf.reshape(degrees, (-1, 1))
-      number_of_edges = tf.math.reduce_sum(degrees)
+      degrees, number_of_edges = _degrees(red_adjacency, adjacency_degrees[1])
       
       
       
 
-      red_graph_pooled = tf.transpose(
-          tf.sparse.sparse_dense_matmul(red_adjacency, assignments))
-      red_graph_pooled = tf.matmul(red_graph_pooled, assignments)
-
-      normalizer_left = tf.matmul(assignments, degrees, transpose_a=True)
-
-      normalizer_right = tf.matmul(degrees, assignments, transpose_a=True)
-
-      normalizer = tf.matmul(normalizer_left,
-                            normalizer_right) / 2 / number_of_edges
-      red_spectral_loss = -tf.linalg.trace(red_graph_pooled -
-                                      normalizer) / 2 / modularity_number_of_edges
+      red_spectral_loss = modularity_term(
+          red_adjacency, assignments, degrees, number_of_edges,
+          modularity_number_of_edges)
     
     
   
@@ -452,37 +826,20 @@ class groupDMoN(tf.keras.layers.Layer):
     
     
     
-    degrees = modularity_degrees  # Size [n].
-    degrees = tf.reshape(degrees, (-1, 1))
-
-    number_of_nodes = adjacency.shape[1]
     
-    if lamda !=1:
+    if not _is_static_weight(lamda, 1):
       #modularity loss
-      graph_pooled = tf.transpose(
-          tf.sparse.sparse_dense_matmul(adjacency, assignments))
-      graph_pooled = tf.matmul(graph_pooled, assignments)
-
-      normalizer_left = tf.matmul(assignments, degrees, transpose_a=True)
-      # Right part is [1, k] tensor.
-      normalizer_right = tf.matmul(degrees, assignments, transpose_a=True)
-
-      # Normalizer is rank-1 correction for degree distribution for degrees of the
-      # nodes in the original graph, casted to the pooled graph.
-      normalizer = tf.matmul(normalizer_left,
-                            normalizer_right) / 2 / modularity_number_of_edges
-      spectral_loss = -tf.linalg.trace(graph_pooled -
-                                      normalizer) / 2 / modularity_number_of_edges
+      spectral_loss = modularity_term(
+          adjacency, assignments, modularity_degrees,
+          modularity_number_of_edges, modularity_number_of_edges)
     
       self.add_loss((1-lamda)*spectral_loss)
 
-    collapse_loss = tf.norm(cluster_sizes) / number_of_nodes * tf.sqrt(
-        float(self.n_clusters)) - 1
+    collapse_loss = tf.sqrt(tf.reduce_sum(
+        tf.square(cluster_sizes))) * self._collapse_scale - 1
     self.add_loss(self.collapse_regularization * collapse_loss)
 
-    features_pooled = tf.matmul(assignments_pooling, features, transpose_a=True)
-    features_pooled = tf.nn.selu(features_pooled)
-    if self.do_unpooling:
-      features_pooled = tf.matmul(assignments_pooling, features_pooled)
+    features_pooled = _pool_features(features, assignments, cluster_sizes,
+                                     self.do_unpooling)
     return features_pooled, assignments
 
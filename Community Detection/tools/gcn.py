@@ -16,11 +16,21 @@
 """Graph Convolutional Network layer, as in Kipf&Welling with modifications.
 
 Modifications include the skip-connection and changing the nonlinearity to SeLU.
+The layer does not use node features: its kernel is a learned (num_nodes *
+n_channels) node embedding table that is propagated over the graph.
 """
 from typing import Tuple
 import tensorflow.compat.v2 as tf
 
 
+@tf.function(jit_compile=True, reduce_retracing=True)
+def _add_skip_and_activate(output, skip_weight, activation):
+    """Adds the skip weight and applies the activation as one XLA kernel.
+
+    The sparse-dense product has no XLA kernel, so only its epilogue is fused.
+    """
+    return activation(output + skip_weight)
+
 
 class GCN(tf.keras.layers.Layer):
     """Implementation of Graph Convolutional Network (GCN) layer without using node features."""
@@ -73,97 +83,6 @@ class GCN(tf.keras.layers.Layer):
         assert len(norm_adjacency.shape) == 2
         
         # Directly use the kernel (node embeddings) instead of `features`
-        output = self.kernel + self.bias
-        output = tf.sparse.sparse_dense_matmul(norm_adjacency, output)
-
-        if self.skip_connection:
-            output += self.skip_weight
-
-        return self.activation(output)
-
-
-class GCN_Original(tf.keras.layers.Layer):
-  """Implementation of Graph Convolutional Network (GCN) layer.
-
-  Attributes:
-    n_channels: Output dimensionality of the layer.
-    skip_connection: If True, node features are propagated without neighborhood
-      aggregation.
-    activation: Activation function to use for the final representations.
-  """
-
-  def __init__(self,
-               n_channels,
-               activation='selu',
-               skip_connection = True):
-    """Initializes the layer with specified parameters."""
-    super(GCN, self).__init__()
-    self.n_channels = n_channels
-    self.skip_connection = skip_connection
-    if isinstance(activation, str):
-      self.activation = tf.keras.layers.Activation(activation)
-    elif isinstance(tf.keras.layers.Activation):
-      self.activation = activation
-    elif activation is None:
-      self.activation = tf.keras.layers.Lambda(lambda x: x)
-    else:
-      raise ValueError('GCN activation of unknown type')
-
-  def build(self, input_shape):
-    """Builds the Keras model according to the input shape."""
-    self.n_features = input_shape[0][-1]
-    self.kernel = self.add_weight(
-        name='kernel',
-        shape=(int(self.n_features), int(self.n_channels)),
-        initializer='glorot_uniform',
-        trainable=True
-    )
-    self.bias = self.add_weight(
-        name='bias',
-        shape=(int(self.n_channels),),
-        initializer='zeros',
-        trainable=True
-    )
-    if self.skip_connection:
-        self.skip_weight = self.add_weight(
-            name='skip_weight',
-            shape=(int(self.n_channels),),
-            initializer='glorot_uniform',
-            trainable=True
-        )
-    else:
-      self.skip_weight = 0
-    super().build(input_shape)
-
-  def call(self, inputs):
-    """Computes GCN representations according to input features and input graph.
-
-    Args:
-      inputs: A tuple of Tensorflow tensors. First element is (n*d) node feature
-        matrix and the second is normalized (n*n) sparse graph adjacency matrix.
-
-    Returns:
-      An (n*n_channels) node representation matrix.
-    """
-    features, norm_adjacency = inputs
-
-    assert isinstance(features, tf.Tensor)
-    assert isinstance(norm_adjacency, tf.SparseTensor)
-    assert len(features.shape) == 2
-    assert len(norm_adjacency.shape) == 2
-    assert features.shape[0] == norm_adjacency.shape[0]
-
-    '''output = tf.matmul(features, self.kernel)
-    if self.skip_connection:
-      output = output * self.skip_weight + tf.sparse.sparse_dense_matmul(
-          norm_adjacency, output)
-    else:
-      output = tf.sparse.sparse_dense_matmul(norm_adjacency, output)
-    output = output + self.bias'''
-    
-    output = tf.matmul(features, self.kernel) + self.bias
-    output = tf.sparse.sparse_dense_matmul(norm_adjacency, output)
-    if self.skip_connection:
-        output += self.skip_weight
-
-    return self.activation(output)
+        output = tf.sparse.sparse_dense_matmul(norm_adjacency,
+                                               self.kernel + self.bias)
+        return _add_skip_and_activate(output, self.skip_weight, self.activation)